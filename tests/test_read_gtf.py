@@ -1,8 +1,32 @@
+import gzip
+import importlib
+import os
+
 import polars as pl
 import polars.testing
+import pytest
 import simple_gtf
 
 
+@pytest.fixture
+def parses(monkeypatch):
+    """
+    Record each call to _join_attributes, which parses the attributes of the rows it is given
+
+    Returns the list of calls, holding the attribute names each was given.
+    """
+    read_gtf_module = importlib.import_module("simple_gtf.read_gtf")
+    join_attributes = read_gtf_module._join_attributes
+    calls = []
+
+    def recording_join_attributes(gtf_contents, all_attributes, *args, **kwargs):
+        calls.append(all_attributes)
+        return join_attributes(gtf_contents, all_attributes, *args, **kwargs)
+
+    monkeypatch.setattr(read_gtf_module, "_join_attributes", recording_join_attributes)
+    return calls
+
+
 def test_read_gtf(resource_path_root):
     gtf_path = resource_path_root / "Mus_musculus.small.gtf.gz"
     expected = resource_path_root / "Mus_musculus.expected.parquet"
@@ -14,3 +38,118 @@ def test_read_gtf(resource_path_root):
 
     expected = expected.select(gtf.columns)
     polars.testing.assert_frame_equal(gtf, expected)
+
+
+def test_read_gtf_cache(resource_path_root, tmp_path, parses):
+    gtf_path = tmp_path / "Mus_musculus.small.gtf.gz"
+    gtf_path.write_bytes(
+        (resource_path_root / "Mus_musculus.small.gtf.gz").read_bytes()
+    )
+
+    gtf = simple_gtf.read_gtf(gtf_path, cache=True)
+    assert len(parses) == 1
+    assert len(list(tmp_path.glob("*.parquet"))) == 1
+    assert not list(tmp_path.glob("*.tmp"))
+
+    # Loaded from the cache without parsing again
+    cached = simple_gtf.read_gtf(gtf_path, cache=True)
+    assert len(parses) == 1
+    polars.testing.assert_frame_equal(gtf, cached)
+
+    # A different set of features gets its own cache
+    genes = simple_gtf.read_gtf(gtf_path, features=["gene"], cache=True)
+    assert len(parses) == 2
+    assert len(list(tmp_path.glob("*.parquet"))) == 2
+    assert genes["feature"].unique().to_list() == ["gene"]
+
+    # Touching the gtf file invalidates the cache
+    stat = gtf_path.stat()
+    os.utime(gtf_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    simple_gtf.read_gtf(gtf_path, cache=True)
+    assert len(parses) == 3
+
+
+def test_read_gtf_attributes_past_sample(resource_path_root, monkeypatch, parses):
+    # Only the first row is sampled for attribute names, so the rest must be found on retry
+    read_gtf_module = importlib.import_module("simple_gtf.read_gtf")
+    monkeypatch.setattr(read_gtf_module, "attribute_name_sample_size", 1)
+
+    gtf_path = resource_path_root / "Mus_musculus.small.gtf.gz"
+    expected = resource_path_root / "Mus_musculus.expected.parquet"
+    gtf = simple_gtf.read_gtf(gtf_path)
+    expected = pl.read_parquet(expected)
+
+    # The rows with names missing from the sample are parsed once more, with every name
+    assert len(parses) == 2
+    assert len(parses[0]) < len(parses[1])
+    assert parses[1] == gtf.columns[8:]
+    assert set(gtf.columns) == set(expected.columns)
+    polars.testing.assert_frame_equal(gtf, expected.select(gtf.columns))
+
+
+def test_read_gtf_sink_path(resource_path_root, tmp_path):
+    gtf_path = resource_path_root / "Mus_musculus.small.gtf.gz"
+    expected = resource_path_root / "Mus_musculus.expected.parquet"
+    sink_path = simple_gtf.read_gtf(gtf_path, sink_path=tmp_path / "gtf.parquet")
+    assert sink_path == tmp_path / "gtf.parquet"
+
+    gtf = pl.read_parquet(sink_path)
+    expected = pl.read_parquet(expected)
+    assert set(gtf.columns) == set(expected.columns)
+    polars.testing.assert_frame_equal(gtf, expected.select(gtf.columns))
+
+
+def test_read_gtf_sink_path_fallbacks(
+    resource_path_root, tmp_path, monkeypatch, parses
+):
+    read_gtf_module = importlib.import_module("simple_gtf.read_gtf")
+    monkeypatch.setattr(read_gtf_module, "attribute_name_sample_size", 1)
+
+    # Attribute names past the sample are listed again and still streamed to the sink
+    gtf_path = resource_path_root / "Mus_musculus.small.gtf.gz"
+    expected = pl.read_parquet(resource_path_root / "Mus_musculus.expected.parquet")
+    sink_path = simple_gtf.read_gtf(gtf_path, sink_path=tmp_path / "gtf.parquet")
+    assert len(parses) == 2
+    gtf = pl.read_parquet(sink_path)
+    polars.testing.assert_frame_equal(gtf, expected.select(gtf.columns))
+
+    # A typed attribute that doesn't convert falls back to loading into memory
+    bad_gtf_path = tmp_path / "bad.gtf"
+    bad_gtf_path.write_text(
+        '1\thavana\texon\t1\t10\t.\t+\t.\tgene_id "A"; exon_number "x";\n'
+        '1\thavana\texon\t1\t10\t.\t+\t.\tgene_id "B"; exon_number "2";\n'
+    )
+    sink_path = simple_gtf.read_gtf(bad_gtf_path, sink_path=tmp_path / "bad.parquet")
+    gtf = pl.read_parquet(sink_path)
+    assert gtf.schema["exon_number"] == pl.List(pl.String)
+    assert gtf["exon_number"].to_list() == [["x"], ["2"]]
+
+
+def test_read_gtf_gzipped(resource_path_root, tmp_path):
+    # The test resource is not actually compressed, so gzip it here
+    gtf_path = tmp_path / "Mus_musculus.small.gtf.gz"
+    gtf_path.write_bytes(
+        gzip.compress((resource_path_root / "Mus_musculus.small.gtf.gz").read_bytes())
+    )
+
+    gtf = simple_gtf.read_gtf(gtf_path)
+    expected = pl.read_parquet(resource_path_root / "Mus_musculus.expected.parquet")
+    assert set(gtf.columns) == set(expected.columns)
+    polars.testing.assert_frame_equal(gtf, expected.select(gtf.columns))
+
+
+def test_read_gtf_typed_attributes(tmp_path):
+    gtf_path = tmp_path / "typed.gtf"
+    gtf_path.write_text(
+        '1\thavana\texon\t1\t10\t.\t+\t.\tgene_id "A"; exon_number "x"; exon_version "1";\n'
+        '1\thavana\texon\t1\t10\t.\t+\t.\tgene_id "B"; exon_number "2"; exon_version "";\n'
+    )
+    gtf = simple_gtf.read_gtf(gtf_path)
+
+    # A value that doesn't convert leaves the whole column as strings, keeping the value
+    assert gtf.schema["exon_number"] == pl.List(pl.String)
+    assert gtf["exon_number"].to_list() == [["x"], ["2"]]
+
+    # Empty values are skipped, so they don't stop the column being converted
+    assert gtf.schema["exon_version"] == pl.List(pl.Int32)
+    assert gtf["exon_version"].to_list() == [[1], []]